@@ -6,29 +6,94 @@ Streamlit Enhanced Version - Chinese UI - With Process All Emails feature
 ───────────────────────────────────────────────────────────────────────────
 1. Streamlit UI for interaction and display (Chinese).
 2. IMAP login (163.com, ID handshake)
-3. Read last run timestamp (for incremental processing).
+3. Read last processed UIDVALIDITY:UID (for incremental processing).
 4. Option to process new emails since last run, or all emails in a default window.
 5. On button click, for each selected message:
     • capture subject + sender + full body text
     • capture every attachment (any filename)
     • send ⟨subject + body + attachment text⟩ to GLM-Z1-Flash
 6. Parse LLM's JSON response & write rows → 年-月-日 基金净值.xlsx (local save & download)
-7. Save current run timestamp.
+7. Save highest processed UID.
 """
 
 import streamlit as st
-import re, json, tempfile, pathlib, datetime, contextlib, io, warnings
-from imapclient import IMAPClient # type: ignore
-import pyzmail, pandas as pd, requests # type: ignore
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import re, json, pathlib, datetime, contextlib, io, warnings, hashlib, sqlite3, time, threading, atexit, random
+import collections, email.parser, email.policy, imaplib, importlib.util
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING
+import pandas as pd, requests # type: ignore
+if TYPE_CHECKING: # Annotations only; the runtime import is in get_imap_connection()
+    from imapclient import IMAPClient # type: ignore
+# imapclient, pyzmail and pdfminer are imported where first used: rendering the page doesn't need them.
+# IMAPClient.Error / IMAPClient.Abort are imaplib's exception classes, so those are caught by their stdlib names.
+IMAP_ERROR, IMAP_ABORT = imaplib.IMAP4.error, imaplib.IMAP4.abort
+from urllib3.util.retry import Retry
 
-# Optional, nicer HTML-to-text if bs4 is around
+# Optional, nicer HTML-to-text: selectolax (C lexbor engine) if around, else lxml, else bs4, else a regex.
+# <script>/<style> contents are dropped first: they are not text and only cost prompt tokens.
+SCRIPT_STYLE_RE = re.compile(r"<(script|style)\b.*?</\1\s*>", re.S | re.I)
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+def html2text_regex(html:str)->str:
+    return HTML_TAG_RE.sub("", SCRIPT_STYLE_RE.sub("", html))
 try:
-    from bs4 import BeautifulSoup # type: ignore
+    from selectolax.parser import HTMLParser # type: ignore
     def html2text(html:str)->str:
-        return BeautifulSoup(html, "html.parser").get_text("\n")
+        tree = HTMLParser(html)
+        tree.strip_tags(["script", "style"])
+        root = tree.body or tree.root
+        return root.text(separator="\n") if root is not None else ""
 except ImportError:
-    def html2text(html:str)->str:
-        return re.sub(r"<[^>]+>", "", html)
+    try:
+        import lxml.html # type: ignore
+        def html2text(html:str)->str:
+            try:
+                doc = lxml.html.fromstring(html)
+            except Exception: # lxml rejects empty or unparseable documents
+                return html2text_regex(html)
+            for node in doc.xpath("//script|//style"):
+                node.drop_tree()
+            return "\n".join(doc.itertext())
+    except ImportError:
+        try:
+            from bs4 import BeautifulSoup # type: ignore
+            def html2text(html:str)->str:
+                soup = BeautifulSoup(html, "html.parser")
+                for node in soup(["script", "style"]):
+                    node.decompose()
+                return soup.get_text("\n")
+        except ImportError:
+            html2text = html2text_regex
+
+# Optional, faster Excel engines: Rust-backed calamine for reading (pandas ≥ 2.2), xlsxwriter for writing
+EXCEL_READ_ENGINES = {".xls": "xlrd", ".xlsx": "openpyxl", ".xlsm": "openpyxl"} # suffix → pandas engine
+try:
+    import python_calamine # type: ignore # noqa: F401
+    if tuple(int(v) for v in pd.__version__.split(".")[:2]) >= (2, 2):
+        EXCEL_READ_ENGINES = dict.fromkeys(EXCEL_READ_ENGINES, "calamine") # calamine reads .xls too
+except ImportError:
+    pass
+try:
+    import xlsxwriter # type: ignore # noqa: F401
+    EXCEL_WRITE_ENGINE = "xlsxwriter"
+except ImportError:
+    EXCEL_WRITE_ENGINE = "openpyxl"
+
+# Optional, faster JSON (de)serialization if orjson is around (its JSONDecodeError subclasses json's)
+try:
+    import orjson # type: ignore
+    def json_loads(data: str | bytes):
+        return orjson.loads(data)
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def json_loads(data: str | bytes):
+        return json.loads(data)
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+# Optional PDF text extraction; without pdfminer.six PDF attachments are skipped
+PDF_TEXT_AVAILABLE = importlib.util.find_spec("pdfminer") is not None
 
 warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
 warnings.filterwarnings("ignore", category=SyntaxWarning, module="pyzmail.utils") 
@@ -41,6 +106,14 @@ EMAIL_PWD  = "DRqdN38whrnCFPGx"     # 请替换为您的实际163邮箱应用授
 GLM_KEY    = "afe7583d73c9d3948f60230e79e08151.Z9HPB84mxuC31DeK" # 请替换为您的实际GLM API Key
 GLM_URL    = "https://open.bigmodel.cn/api/paas/v4/chat/completions"
 MODEL      = "glm-z1-flash" # 或者您偏好的模型，如 "glm-4", "glm-3-turbo"
+GLM_MAX_TOKENS = 8192 # 输出上限；每次调用的附件最多 ATTACH_SEGMENT_ROWS 行，每行回答约 40 tokens，余量留给 glm-z1 的推理过程
+GLM_RESPONSE_FORMAT = {"type": "json_object"} # JSON 模式；所用模型不支持时设为 None
+# 服务器端预筛选：配置了发件域名时只搜索这些发件人的邮件，否则按主题关键词搜索；两者皆空则不筛选
+NAV_SENDER_DOMAINS   = set() # 例如 {"fund.com", "asset.com"}
+NAV_SUBJECT_KEYWORDS = ("净值", "估值", "基金", "NAV") # 托管/外包机构净值邮件常用的主题词
+# 客户端预筛选：下载正文前只取 Subject/From 头，主题匹配或发件域名在 NAV_SENDER_DOMAINS 中才下载；设为 None 则关闭
+# (仅在上面两项皆空、服务器端未筛选时生效，否则与服务器端条件重复)
+NAV_PRESCREEN_RE = re.compile(r"净值|估值|NAV|基金", re.I)
 # ─────────────────────────────────────────────────────────────────────────
 
 TODAY   = datetime.date.today().strftime("%Y-%m-%d") 
@@ -49,167 +122,575 @@ SHEET   = TODAY
 COLS    = ["日期","基金名称","基金代码","单位净值","累计净值",
            "原邮件名","发件人","发件机构"]
 
-# ─── Timestamp logging for incremental processing ─────────────────────
+# ─── UID bookkeeping for incremental processing ───────────────────────
 LOG_DIR = pathlib.Path("log")
-LAST_RUN_FILE = LOG_DIR / "last_run.txt"
-DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S" 
+LAST_RUN_FILE = LOG_DIR / "last_run.json" # {"uidvalidity": V, "uid": 最高已处理UID, "saved_at": 保存时间 (UTC)}
+LEGACY_LAST_RUN_FILE = LOG_DIR / "last_run.txt" # 旧格式 "UIDVALIDITY:UID"，仅在 JSON 记录不存在时读取
+NAV_STORE = LOG_DIR / f"{TODAY}_nav.parquet" # 当日全部提取结果；每次运行据此重新生成 XLSX
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# ─── IMAP fetch tuning ────────────────────────────────────────────────
+FETCH_BATCH = 100 # 每次 FETCH 请求的邮件数；服务器报告请求过大时自动减半
+IDLE_TIMEOUT = 300 # 监听模式下每轮 IMAP IDLE 的秒数；超时即重新 IDLE，同时起到保活作用 (RFC 2177 要求 < 29 分钟)
+IDLE_POLL_SECONDS = 1 # IDLE 期间每隔多少秒让出一次，使取消勾选、Stop 或点击按钮能及时生效
+HEADER_FETCH = b"BODY.PEEK[HEADER.FIELDS (SUBJECT FROM)]" # 预筛选只取这两个头，同样不设置 \Seen
+HEADER_PARSER = email.parser.BytesHeaderParser(policy=email.policy.default) # 解码 =?utf-8?...?= 主题
+
+# ─── GLM response cache ───────────────────────────────────────────────
+GLM_CACHE_FILE = LOG_DIR / "glm_cache.sqlite"
+GLM_CACHE_MAX_ENTRIES = 5000 # 超出后按最近使用时间淘汰最旧条目 (LRU)
+GLM_CACHE_TTL_DAYS = 90 # 超过该天数未被使用的缓存条目视为过期；设为 None 则永不过期
+GLM_CACHE_LOCK = threading.Lock() # GLM线程池共用一个缓存文件，串行访问避免 "database is locked"
+
+# ─── GLM concurrency ──────────────────────────────────────────────────
+GLM_CONCURRENCY = 8 # 并发调用GLM的线程数
+GLM_MAX_INFLIGHT = 8 # 同时在途的GLM请求上限，按账户配额调整；遇到429/5xx时自动减半，成功后逐步恢复
+GLM_RPM = 60 # 每分钟请求数上限 (按账户配额调整)
+GLM_TPM = 300000 # 每分钟输入 token 上限 (按 字符数/3 估算)
+GLM_MAX_ATTEMPTS = 5 # 单次GLM调用的最多尝试次数 (含首次)
+GLM_RETRY_STATUS = {429, 500, 502, 503, 504}
+GLM_TIMEOUT = (10, 60) # (连接, 读取) 秒；流式响应下读取超时指两次数据块之间的最长间隔，而非整个回答的时长
+LOG_LOCK = threading.Lock()
+LOG_PROBLEM_RE = re.compile(r"警告|失败|错误|error", re.I)
+LOG_LEVEL_ICONS = {"success": "✅", "warning": "⚠️", "error": "❌", "info": ""}
+
+class GlmRateLimiter:
+    """Admission control for GLM calls.
+
+    A call is admitted once it fits the in-flight cap and the sliding one-minute
+    RPM/TPM budget. The in-flight cap is AIMD: halved on 429/5xx, grown by
+    1/cap per success back up to max_inflight.
+    """
+    def __init__(self, rpm: int, tpm: int, max_inflight: int):
+        self.rpm, self.tpm, self.max_inflight = rpm, tpm, max_inflight
+        self.limit = float(max_inflight)
+        self.inflight = 0
+        self.window = collections.deque() # (admitted at, estimated tokens) over the last minute
+        self.cond = threading.Condition()
+
+    def acquire(self, tokens: int):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.window and now - self.window[0][0] >= 60:
+                    self.window.popleft()
+                used = sum(t for _, t in self.window)
+                if self.inflight < int(self.limit):
+                    # A single oversized prompt is still admitted into an empty window
+                    if len(self.window) < self.rpm and (used + tokens <= self.tpm or not self.window):
+                        self.inflight += 1
+                        self.window.append((now, tokens))
+                        return
+                    self.cond.wait(timeout=60 - (now - self.window[0][0]))
+                else:
+                    self.cond.wait()
+
+    def release(self, overloaded: bool = False):
+        with self.cond:
+            self.inflight -= 1
+            if overloaded:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_inflight), self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+GLM_LIMITER = GlmRateLimiter(GLM_RPM, GLM_TPM, GLM_MAX_INFLIGHT)
+
+# One pooled keep-alive session for all GLM calls: the TCP+TLS handshake is paid once per connection
+GLM_SESSION = requests.Session()
+# The adapter only retries failed connects (nothing was sent yet); HTTP 429/5xx retries stay in glm(),
+# where they go back through GLM_LIMITER and shrink its in-flight cap.
+GLM_SESSION.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=GLM_CONCURRENCY,
+    max_retries=Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.5)))
+GLM_SESSION.headers.update({"Authorization": f"Bearer {GLM_KEY}", "Content-Type": "application/json"})
+
+# ─── UI refresh ───────────────────────────────────────────────────────
+UI_MAX_UPDATES = 50 # 每个阶段进度条/状态文字最多刷新的次数；每次刷新都是一条发往浏览器的消息
+
+def ui_update_due(i: int, total: int) -> bool:
+    """True on every ~total/UI_MAX_UPDATES-th of `total` steps, and on the last one."""
+    return i == total or i % max(1, total // UI_MAX_UPDATES) == 0
+
+# ─── Attachment parsing ───────────────────────────────────────────────
+ATTACH_WORKERS = 4 # 解析附件的线程数；附件在后台解析，同时继续下载后续邮件
+ATTACH_PIPELINE_DEPTH = 8 # 最多同时有多少封邮件的附件在排队解析
+
+# ─── Prompt sizing ────────────────────────────────────────────────────
+GLM_PROMPT_TOKEN_BUDGET = 12000 # 单次GLM调用的输入 token 预算 (按 字符数/3 估算)，正文与附件合并发送直至达到预算
+ATTACH_SEGMENT_CHARS = 20000 # 单次GLM调用中附件文本的字符上限，超出则分段
+ATTACH_SEGMENT_ROWS = 120 # 单次GLM调用中附件的行数上限 (表格行或文本行)，保证回答不超出 GLM_MAX_TOKENS
+BODY_MAX_CHARS = 12000 # 邮件正文压缩后的字符上限，超出时截取首个净值关键词附近的内容，无关键词则保留首尾各一半 (正文会随每个分批请求重复发送)
+ATTACHMENT_SUFFIXES = {".xls", ".xlsx", ".xlsm", ".csv", ".txt", ".html", ".htm"} # 其余附件类型直接跳过
+if PDF_TEXT_AVAILABLE:
+    ATTACHMENT_SUFFIXES.add(".pdf")
+# 文件名没有可识别扩展名时 (如 "净值表" 或 ".dat")，先按 MIME 类型、再按文件头魔数推断
+ATTACHMENT_MIME_SUFFIXES = {
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
+    "application/vnd.ms-excel.sheet.macroenabled.12": ".xlsm",
+    "application/vnd.ms-excel": ".xls",
+    "text/csv": ".csv",
+    "text/plain": ".txt",
+    "text/html": ".html",
+    "application/pdf": ".pdf",
+}
+ATTACHMENT_MAGIC_SUFFIXES = ((b"PK\x03\x04", ".xlsx"), (b"\xd0\xcf\x11\xe0", ".xls"), (b"%PDF", ".pdf"))
+SPREADSHEET_SUFFIXES = {".xls", ".xlsx", ".xlsm"}
+TEXT_MIN_CHARS = 16 # 文本附件 (含PDF提取结果) 压缩后少于此字符数则视为无内容
+TEXT_PRINTABLE_RATIO = 0.9 # 可打印字符占比低于此值的文本附件视为二进制内容，不送入GLM
+NAV_COLUMN_RE = re.compile(r"日期|净值|代码|名称|产品|基金")
+# GLM回复中的JSON：优先匹配 ```json 代码块内的内容，否则取第一个 [ 或 { 到最后一个 ] 或 }
+JSON_EXTRACT_RE = re.compile(r"```(?:json)?\s*(\[.*\]|\{.*\})\s*```|(\[.*\]|\{.*\})", re.S)
+THINK_RE = re.compile(r"<think>.*?</think>", re.S | re.I) # GLM-Z1 推理过程，其中的括号不能被当作JSON
+# 压缩提示词上下文：HTML残留、URL/邮箱/电话替换为占位标记、多余空白
+HTML_REMNANT_RE = re.compile(r"<[^>\n]+>|&(?:nbsp|amp|lt|gt|quot);")
+URL_RE = re.compile(r"https?://\S+")
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+PHONE_RE = re.compile(r"(?<![\d.])(?:1[3-9]\d{9}|0\d{2,3}-\d{7,8}|400-?\d{3}-?\d{4})(?![\d.])")
+INLINE_SPACE_RE = re.compile(r"[ \u3000]+") # Tabs are kept: each one is a column boundary in tab-separated exports
+BLANK_LINES_RE = re.compile(r"\n\s*\n\s*\n+")
+# 正文模板解析：逐字段标注的净值通知 ("基金名称：… 基金代码：… 净值日期：… 单位净值：… 累计净值：…")
+# 字段之间的间隔不得越过下一个 "基金名称：" 标签，否则缺字段的记录会拼上下一只基金的数值
+_LABEL_GAP = r"(?:(?!(?:基金|产品)名称[:：]).){0,200}?"
+LABELLED_NAV_RE = re.compile(
+    r"(?:基金|产品)名称[:：]\s*(?P<name>[^\s，,；;]+)" + _LABEL_GAP +
+    r"(?:基金|产品)代码[:：]\s*(?P<code>[A-Za-z0-9]{6})\b" + _LABEL_GAP +
+    r"(?:净值|估值)?日期[:：]\s*(?P<date>\d{4}\s*[-/.年]\s*\d{1,2}\s*[-/.月]\s*\d{1,2})日?" + _LABEL_GAP +
+    r"(?:基金)?(?:单位|份额)净值[:：]\s*(?P<unit>\d[\d,]*\.\d+)" + _LABEL_GAP +
+    r"累计(?:单位|份额)?净值[:：]\s*(?P<acc>\d[\d,]*\.\d+)", re.S)
+# 净值数据必然出现的关键词：整封邮件 (主题+正文+全部附件) 都不含时不调用GLM
+NAV_CONTENT_RE = re.compile(r"净值|估值|NAV", re.I)
+# 文件名/主题中的完整日期，用于没有日期列的结构化附件：只认8位 "20240510" 或全程带分隔符的 "2024-05-10"、"2024年5月10日"
+# (不带分隔符的5~7位数字多为以20开头的基金代码，不能当作日期)
+NAME_DATE_RE = re.compile(r"(?<!\d)(20\d{2})(?:(\d{2})(\d{2})|[-_./年](\d{1,2})[-_./月](\d{1,2})日?)(?!\d)")
+
+# 表头别名 → 目标字段；附件表头匹配至少4个字段时直接解析，无需调用GLM (无日期列时须能从文件名或主题取得日期)
+NAV_HEADER_ALIASES = {
+    "日期": {"日期", "净值日期", "估值日期", "估值基准日", "业务日期"},
+    "基金名称": {"基金名称", "产品名称", "基金简称", "产品简称", "名称"},
+    "基金代码": {"基金代码", "产品代码", "代码", "备案编码", "协会备案编码", "产品备案编码"},
+    "单位净值": {"单位净值", "基金单位净值", "份额净值", "基金份额净值"},
+    "累计净值": {"累计净值", "累计单位净值", "基金累计净值", "累计份额净值"},
+}
+
+# GLM返回的每个基金对象须包含全部目标字段；净值可为数字或字符串 (由 coerce_nav_columns 统一转换)
+NAV_ITEM_SCHEMA = {
+    "type": "object",
+    "required": list(NAV_HEADER_ALIASES),
+    "properties": {
+        "日期": {"type": ["string", "null"]},
+        "基金名称": {"type": ["string", "null"]},
+        "基金代码": {"type": ["string", "number", "null"]},
+        "单位净值": {"type": ["number", "string", "null"]},
+        "累计净值": {"type": ["number", "string", "null"]},
+    },
+}
+
+# Optional, compiled schema validation for GLM items if fastjsonschema is around, else a key check
+try:
+    import fastjsonschema # type: ignore
+    validate_nav_item = fastjsonschema.compile(NAV_ITEM_SCHEMA)
+    NavItemInvalid = fastjsonschema.JsonSchemaException
+except ImportError:
+    class NavItemInvalid(ValueError):
+        pass
+    def validate_nav_item(item):
+        if not isinstance(item, dict):
+            raise NavItemInvalid("非字典格式")
+        if not set(NAV_ITEM_SCHEMA["required"]).issubset(item.keys()):
+            raise NavItemInvalid("缺少预期键")
+        return item
 
 # Initialize session state variables
 if 'processing_log' not in st.session_state:
     st.session_state.processing_log = []
 if 'processed_df' not in st.session_state:
     st.session_state.processed_df = None
+    st.session_state.processed_xlsx = None # Download bytes, built once per run rather than on every rerun
 if 'run_summary' not in st.session_state:
     st.session_state.run_summary = {}
+if 'imap_client' not in st.session_state:
+    st.session_state.imap_client = None # Kept alive across button clicks, see get_imap_connection
+    st.session_state.imap_lock = threading.Lock()
 
 def append_log(message, level="info"):
+    """Record (display level, line); the level is classified once here rather than on every rerun."""
+    if level not in ("warning", "error"):
+        if LOG_PROBLEM_RE.search(message):
+            level = "warning"
+        elif "GLM从" in message or "直接解析到" in message:
+            level = "success"
     timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-    st.session_state.processing_log.append(f"[{timestamp}] {message}")
+    with LOG_LOCK: # glm() logs from worker threads
+        st.session_state.processing_log.append((level, f"[{timestamp}] {message}"))
 
-def get_last_run_datetime() -> datetime.datetime | None:
-    if not LAST_RUN_FILE.exists():
-        append_log("未找到上次运行时间戳文件。将使用默认时间窗口进行处理。", "info")
-        return None
-    try:
-        content = LAST_RUN_FILE.read_text().strip()
+def read_last_run_record() -> dict | None:
+    """Load the last-run record as {"uidvalidity", "uid", "saved_at"}, or None if there is none.
+
+    Falls back to the legacy "UIDVALIDITY:UID" text file; raises ValueError,
+    KeyError or OSError on a corrupt record.
+    """
+    if LAST_RUN_FILE.exists():
+        content = LAST_RUN_FILE.read_bytes()
+        if not content.strip():
+            return None
+        record = json_loads(content)
+        if not isinstance(record, dict):
+            raise ValueError(f"运行记录不是JSON对象: {content[:100]!r}")
+        return record
+    if LEGACY_LAST_RUN_FILE.exists():
+        content = LEGACY_LAST_RUN_FILE.read_text().strip()
         if not content:
-            append_log("上次运行时间戳文件为空。将使用默认时间窗口进行处理。", "info")
             return None
-        dt_naive = datetime.datetime.strptime(content, DATETIME_FORMAT)
-        dt_utc = dt_naive.replace(tzinfo=datetime.timezone.utc)
-        append_log(f"上次运行时间戳: {dt_utc.strftime(DATETIME_FORMAT)} UTC", "info")
-        return dt_utc
-    except (ValueError, OSError) as e:
-        append_log(f"读取或解析上次运行时间戳文件 {LAST_RUN_FILE} 失败: {e}。将使用默认时间窗口进行处理。", "warning")
+        uid_line, _, saved_at_line = content.partition("\n")
+        uidvalidity_str, uid_str = uid_line.split(":")
+        return {"uidvalidity": int(uidvalidity_str), "uid": int(uid_str), "saved_at": saved_at_line.strip() or None}
+    return None
+
+def get_last_run_state() -> tuple[int, int, datetime.datetime | None] | None:
+    """Return the stored (UIDVALIDITY, highest processed UID, saved-at UTC time), or None."""
+    try:
+        record = read_last_run_record()
+        if record is None:
+            append_log("未找到上次运行记录。将使用默认时间窗口进行处理。", "info")
+            return None
+        saved_at = record.get("saved_at")
+        saved_at = (datetime.datetime.strptime(saved_at, DATETIME_FORMAT)
+                    .replace(tzinfo=datetime.timezone.utc) if saved_at else None)
+        state = (int(record["uidvalidity"]), int(record["uid"]), saved_at)
+        append_log(f"上次运行记录: UIDVALIDITY={state[0]}, 最高已处理UID={state[1]}", "info")
+        return state
+    except (ValueError, KeyError, TypeError, OSError) as e:
+        append_log(f"读取或解析上次运行记录 {LAST_RUN_FILE} 失败: {e}。将使用默认时间窗口进行处理。", "warning")
         return None
 
-def save_current_run_datetime():
+def save_current_run_state():
+    summary = st.session_state.run_summary
+    uidvalidity, last_uid = summary.get('uidvalidity'), summary.get('last_uid')
+    if uidvalidity is None or last_uid is None:
+        append_log("本次运行未获取到UID信息，保留原有运行记录。", "warning")
+        return
     try:
         LOG_DIR.mkdir(parents=True, exist_ok=True)
         now_utc = datetime.datetime.now(datetime.timezone.utc)
-        LAST_RUN_FILE.write_text(now_utc.strftime(DATETIME_FORMAT))
-        append_log(f"已保存当前运行时间戳: {now_utc.strftime(DATETIME_FORMAT)} UTC 至 {LAST_RUN_FILE}", "info")
+        record = {"uidvalidity": uidvalidity, "uid": last_uid, "saved_at": now_utc.strftime(DATETIME_FORMAT)}
+        tmp_file = LAST_RUN_FILE.with_suffix(".tmp")
+        tmp_file.write_bytes(json_dumps(record))
+        tmp_file.replace(LAST_RUN_FILE) # Atomic: a crash mid-write never leaves a half-written record
+        append_log(f"已保存运行记录: UIDVALIDITY={uidvalidity}, 最高已处理UID={last_uid} 至 {LAST_RUN_FILE}", "info")
         st.session_state.current_run_timestamp_display = f"{now_utc.strftime(DATETIME_FORMAT)} UTC"
     except OSError as e:
-        append_log(f"无法保存当前运行时间戳至 {LAST_RUN_FILE}: {e}", "warning")
+        append_log(f"无法保存运行记录至 {LAST_RUN_FILE}: {e}", "warning")
 
-def fetch_mail(last_run_utc_dt: datetime.datetime | None = None,
+def logout_quietly(srv):
+    try:
+        srv.logout()
+    except Exception:
+        pass
+
+def get_imap_connection() -> "IMAPClient":
+    """Return this session's logged-in IMAP connection, reconnecting only if it has gone stale."""
+    srv = st.session_state.imap_client
+    if srv is not None:
+        try:
+            srv.noop()
+            return srv
+        except Exception:
+            append_log("IMAP连接已失效，正在重新连接...", "info")
+            logout_quietly(srv)
+    from imapclient import IMAPClient # type: ignore
+    srv = IMAPClient(IMAP_HOST, ssl=True)
+    srv.login(EMAIL_USER, EMAIL_PWD)
+    try:
+        srv.id_({"name":"python-streamlit","version":"0.9.4","vendor":"myclient",
+                 "contact":EMAIL_USER})
+    except Exception:
+        pass
+    atexit.register(logout_quietly, srv)
+    st.session_state.imap_client = srv
+    return srv
+
+def nav_search_filter() -> tuple[list, str]:
+    """IMAP criteria restricting a search to likely NAV mail, plus a description for the log.
+
+    Terms are OR'ed in prefix form: OR t1 OR t2 t3.
+    """
+    if NAV_SENDER_DOMAINS:
+        terms = [["FROM", f"@{domain}"] for domain in sorted(NAV_SENDER_DOMAINS)]
+        description = f"发件域名: {', '.join(sorted(NAV_SENDER_DOMAINS))}"
+    elif NAV_SUBJECT_KEYWORDS:
+        terms = [["SUBJECT", keyword] for keyword in NAV_SUBJECT_KEYWORDS]
+        description = f"主题关键词: {', '.join(NAV_SUBJECT_KEYWORDS)}"
+    else:
+        return [], ""
+    criteria = []
+    for k, term in enumerate(terms):
+        if k < len(terms) - 1:
+            criteria.append("OR")
+        criteria.extend(term)
+    return criteria, description
+
+def fetch_in_batches(srv, ids, fetch_items, batch_size: int = FETCH_BATCH):
+    """Yield (chunk, data_map) pairs, one FETCH round trip per chunk of `ids`.
+
+    Halves the chunk size and retries when the server rejects the request as
+    too large; a chunk that fails for any other reason is logged and yielded
+    with an empty map so callers can still account for its ids.
+    """
+    k = 0
+    while k < len(ids):
+        chunk = ids[k:k + batch_size]
+        try:
+            data_map = srv.fetch(chunk, fetch_items)
+        except IMAP_ABORT as e_abort:
+            append_log(f"获取邮件ID {chunk[0]}-{chunk[-1]} 期间发生IMAP中止错误: {e_abort}", "error")
+            raise
+        except Exception as e_fetch:
+            if "maximum request size" in str(e_fetch).lower() and batch_size > 1:
+                batch_size = max(1, batch_size // 2)
+                append_log(f"批量获取超出服务器请求大小限制，批大小减半为 {batch_size} 后重试。", "warning")
+                continue
+            append_log(f"获取邮件ID {chunk[0]}-{chunk[-1]} 失败: {e_fetch}", "error")
+            data_map = {}
+        k += len(chunk)
+        yield chunk, data_map
+
+def wait_for_new_mail(timeout: int = IDLE_TIMEOUT, on_poll=None) -> bool:
+    """Wait in one IMAP IDLE on INBOX until the server pushes new mail (EXISTS) or `timeout` seconds pass.
+
+    The wait is polled in IDLE_POLL_SECONDS slices, calling `on_poll()` between
+    them: any st.* call there lets Streamlit stop or rerun the script (its
+    exception ends the IDLE on the way out) instead of blocking for `timeout`.
+    """
+    deadline = time.monotonic() + timeout
+    with st.session_state.imap_lock:
+        srv = get_imap_connection()
+        srv.select_folder("INBOX", readonly=True)
+        srv.idle()
+        try:
+            while (remaining := deadline - time.monotonic()) > 0:
+                responses = srv.idle_check(timeout=min(IDLE_POLL_SECONDS, remaining))
+                if any(len(r) > 1 and r[1] == b"EXISTS" for r in responses):
+                    return True
+                if on_poll:
+                    on_poll()
+        finally:
+            srv.idle_done()
+    return False
+
+def header_looks_like_nav(raw_headers: bytes) -> bool:
+    """Prescreen on Subject/From only: NAV-looking subject, or a sender in NAV_SENDER_DOMAINS."""
+    try:
+        headers = HEADER_PARSER.parsebytes(raw_headers)
+        if NAV_PRESCREEN_RE.search(str(headers.get("Subject", ""))):
+            return True
+        domain = str(headers.get("From", "")).rpartition("@")[2].strip(" >").lower()
+        return domain in NAV_SENDER_DOMAINS
+    except Exception: # Unparseable headers: download the message rather than miss it
+        return True
+
+def fetch_mail(last_run_state: tuple[int, int, datetime.datetime | None] | None = None,
                default_days_lookback: int = 30,
                process_all_emails_flag: bool = False, # New parameter
                progress_bar=None, status_text=None):
     try:
-        with IMAPClient(IMAP_HOST, ssl=True) as srv:
-            srv.login(EMAIL_USER, EMAIL_PWD)
-            try:
-                srv.id_({"name":"python-streamlit","version":"0.9.4","vendor":"myclient",
-                         "contact":EMAIL_USER})
-            except Exception:
-                pass
-            
-            srv.select_folder("INBOX")
+        with st.session_state.imap_lock:
+            srv = get_imap_connection()
+            select_info = srv.select_folder("INBOX")
+            uidvalidity = select_info.get(b"UIDVALIDITY")
             
             search_description_text = ""
-            using_last_run_filter = False # Will be True only for normal incremental runs to enable client-side time filtering
+            last_uid = 0 # Only set for UID-based incremental runs
+            resync_after = None # Set when UIDVALIDITY changed: keep only mail received after the last run
 
             if process_all_emails_flag:
                 search_criteria = ['ALL']
                 search_description_text = "收件箱中的所有邮件"
-                # using_last_run_filter remains False, as last_run_utc_dt is None in this mode from run_processing
-            elif last_run_utc_dt: # Normal incremental run (has a last run timestamp)
-                if last_run_utc_dt.tzinfo is None or last_run_utc_dt.tzinfo.utcoffset(last_run_utc_dt) is None:
-                    last_run_utc_dt = last_run_utc_dt.replace(tzinfo=datetime.timezone.utc)
-                since_date_for_imap = last_run_utc_dt.date() # IMAP SINCE uses date part
+            elif last_run_state and last_run_state[0] == uidvalidity: # Normal incremental run
+                last_uid = last_run_state[1]
+                search_criteria = ["UID", f"{last_uid + 1}:*"]
+                search_description_text = f"UID 大于 {last_uid} 的新邮件"
+            elif last_run_state and last_run_state[2]: # UIDVALIDITY changed: resync by time since the last run
+                resync_after = last_run_state[2]
+                append_log(f"收件箱 UIDVALIDITY 已变化 ({last_run_state[0]} → {uidvalidity})，"
+                           f"将按上次运行时间重新同步。", "warning")
+                since_date_for_imap = resync_after.date() # IMAP SINCE uses date part
                 search_criteria = ["SINCE", since_date_for_imap]
-                search_description_text = (f"自 {last_run_utc_dt.strftime(DATETIME_FORMAT)} UTC "
+                search_description_text = (f"自 {resync_after.strftime(DATETIME_FORMAT)} UTC "
                                            f"(服务器搜索起始日期: {since_date_for_imap.strftime('%Y-%m-%d')})")
-                using_last_run_filter = True # Enable precise client-side time filtering
-            else: # Fallback: Not process_all_emails_flag AND last_run_utc_dt is None
-                  # This is typically the first run of "Process New Emails".
+            else: # Fallback: no usable record, typically the first run of "Process New Emails".
+                if last_run_state:
+                    append_log(f"收件箱 UIDVALIDITY 已变化 ({last_run_state[0]} → {uidvalidity})，"
+                               f"将按默认时间窗口重新同步。", "warning")
                 since_date_for_imap = (datetime.datetime.now(datetime.timezone.utc).date() - 
                                        datetime.timedelta(days=default_days_lookback))
                 search_criteria = ["SINCE", since_date_for_imap]
-                search_description_text = (f"首次运行或无时间戳，处理最近 {default_days_lookback} 天 "
+                search_description_text = (f"首次运行或无运行记录，处理最近 {default_days_lookback} 天 "
                                            f"(服务器搜索起始日期: {since_date_for_imap.strftime('%Y-%m-%d')})")
-                # using_last_run_filter remains False, as last_run_utc_dt is None.
 
-            ids = srv.search(search_criteria)
+            nav_filter, nav_filter_description = nav_search_filter()
+            unfiltered_count = None
+            if nav_filter:
+                # One extra SEARCH (UIDs only, no bodies) just to report what the filter saved
+                unfiltered_count = len(srv.search(search_criteria))
+                search_criteria = [c for c in search_criteria if c != 'ALL'] + nav_filter
+                search_description_text += f"，{nav_filter_description}"
+            # Ascending UIDs: the saved high-water mark then never passes an unprocessed message
+            ids = sorted(srv.search(search_criteria, charset="UTF-8"))
+            if unfiltered_count is not None:
+                append_log(f"服务器端预筛选: {unfiltered_count} 封邮件中排除了 {max(unfiltered_count - len(ids), 0)} 封。", "info")
+            if last_uid:
+                ids = [mid for mid in ids if mid > last_uid] # "N:*" always matches the newest message
+            if resync_after and ids:
+                # SINCE is day-granular: one cheap INTERNALDATE fetch drops same-day mail from before
+                # the last run, before any body is downloaded.
+                keep = []
+                for chunk, date_map in fetch_in_batches(srv, ids, [b"INTERNALDATE"], batch_size=len(ids)):
+                    for mid in chunk:
+                        internal_date = date_map.get(mid, {}).get(b"INTERNALDATE")
+                        # IMAPClient returns naive local time; astimezone() reads naive values as local
+                        if internal_date is None or internal_date.astimezone(datetime.timezone.utc) > resync_after:
+                            keep.append(mid)
+                append_log(f"按接收时间筛选后剩余 {len(keep)}/{len(ids)} 封邮件待下载。", "info")
+                ids = keep
             append_log(f"发现 {len(ids)} 封候选邮件 ({search_description_text})。", "info")
             st.session_state.run_summary['emails_found_server'] = len(ids)
+            st.session_state.run_summary['uidvalidity'] = uidvalidity
+            st.session_state.run_summary['last_uid'] = last_uid
+
+            screened_max_uid = 0 # Mail dropped by the prescreen still counts as handled
+            # Only when the server search was unfiltered: after a SUBJECT search the prescreen would
+            # re-test the same keywords, after a FROM search its sender test passes every result
+            if NAV_PRESCREEN_RE is not None and not nav_filter and ids:
+                keep = []
+                for chunk, header_map in fetch_in_batches(srv, ids, [HEADER_FETCH]):
+                    for mid in chunk:
+                        # The response key echoes the request, modulo server quoting of the field names
+                        raw_headers = next((v for k, v in header_map.get(mid, {}).items()
+                                            if k.startswith(b"BODY[HEADER")), None)
+                        if raw_headers is None or header_looks_like_nav(raw_headers):
+                            keep.append(mid)
+                if len(keep) < len(ids):
+                    append_log(f"按主题/发件人预筛选后剩余 {len(keep)}/{len(ids)} 封邮件待下载。", "info")
+                    screened_max_uid = ids[-1]
+                ids = keep
             
             if not ids:
+                if not last_uid: # Nothing in the window: older mail counts as handled
+                    st.session_state.run_summary['last_uid'] = max(select_info.get(b"UIDNEXT", 1) - 1, 0)
+                else:
+                    st.session_state.run_summary['last_uid'] = max(last_uid, screened_max_uid)
                 append_log("没有邮件符合服务器端条件。", "info")
                 if progress_bar: progress_bar.progress(1.0)
                 if status_text: status_text.text("服务器上未找到符合条件的邮件。")
                 return
 
+            st.session_state.run_summary['emails_to_download'] = len(ids) # Also paces the per-email UI updates
+            from pyzmail import PyzMessage # type: ignore
             fetched_count = 0
-            for i, mid in enumerate(ids):
-                if progress_bar: progress_bar.progress((i + 1) / len(ids))
-                if status_text: status_text.text(f"正在获取和筛选: {i+1}/{len(ids)}")
-                
-                try:
-                    raw_email_data_map = srv.fetch([mid], [b"RFC822", b"INTERNALDATE"])
-                except IMAPClient.Abort as e_abort: 
-                    append_log(f"获取邮件ID {mid} 期间发生IMAP中止错误: {e_abort}", "error")
-                    raise 
-                except Exception as e_fetch:
-                    append_log(f"获取邮件ID {mid} 失败: {e_fetch}", "error")
-                    continue 
-
-                if not raw_email_data_map or mid not in raw_email_data_map:
-                    append_log(f"警告: 无法获取邮件ID {mid} 的完整数据", "warning")
-                    continue 
-                
-                message_data = raw_email_data_map[mid]
-
-                if b"RFC822" not in message_data:
-                    append_log(f"警告: 无法获取邮件ID {mid} 的RFC822 (正文)", "warning")
-                    continue
+            i = 0
+            # Lowest UID whose body could not be fetched: the saved high-water mark has to stay below it,
+            # or a transient FETCH error would skip that message (and the rest of its chunk) for good
+            first_unfetched_uid = None
+            # BODY.PEEK[] returns the same bytes as RFC822 (under b"BODY[]") without setting \Seen
+            for chunk, raw_email_data_map in fetch_in_batches(srv, ids, [b"BODY.PEEK[]"]):
+                for mid in chunk: # Walk the chunk in `ids` order, not dict order
+                    i += 1
+                    if ui_update_due(i, len(ids)):
+                        if progress_bar: progress_bar.progress(i / len(ids))
+                        if status_text: status_text.text(f"正在获取邮件: {i}/{len(ids)}")
 
-                # Client-side filtering for incremental processing if last_run_utc_dt was provided and applicable
-                if using_last_run_filter and last_run_utc_dt: 
-                    internal_date_from_server = message_data.get(b'INTERNALDATE') 
-                    
-                    if internal_date_from_server:
-                        if internal_date_from_server.tzinfo is None or \
-                           internal_date_from_server.tzinfo.utcoffset(internal_date_from_server) is None:
-                            internal_date_from_server = internal_date_from_server.replace(tzinfo=datetime.timezone.utc)
-                        
-                        if internal_date_from_server <= last_run_utc_dt:
-                            continue # Skip this email as it's not newer than the last run
-                    else:
-                        append_log(f"警告: 邮件ID {mid} 缺少INTERNALDATE。无法按确切时间筛选，将基于日期匹配进行处理。", "warning")
-                
-                fetched_count += 1
-                yield pyzmail.PyzMessage.factory(message_data[b"RFC822"])
-            
+                    # pop() so each raw body is released once parsed, not held until the chunk ends
+                    message_data = raw_email_data_map.pop(mid, None)
+                    if message_data is None:
+                        append_log(f"警告: 无法获取邮件ID {mid} 的完整数据", "warning")
+                        first_unfetched_uid = first_unfetched_uid or mid # `ids` ascend: the first miss is the lowest
+                        continue
+
+                    raw_body = message_data.get(b"BODY[]")
+                    del message_data
+                    if raw_body is None:
+                        append_log(f"警告: 无法获取邮件ID {mid} 的BODY[] (正文)", "warning")
+                        first_unfetched_uid = first_unfetched_uid or mid
+                        continue
+
+                    fetched_count += 1
+                    msg = PyzMessage.factory(raw_body)
+                    del raw_body
+                    yield msg
+                    # Resumed by the consumer once it has queued this message. Its rows are only
+                    # written after the GLM phase, so run_processing persists this UID only then.
+                    if first_unfetched_uid is None:
+                        st.session_state.run_summary['last_uid'] = max(st.session_state.run_summary['last_uid'], mid)
+
+            if first_unfetched_uid is None:
+                st.session_state.run_summary['last_uid'] = max(st.session_state.run_summary['last_uid'], screened_max_uid)
+            else:
+                append_log(f"邮件ID {first_unfetched_uid} 起有邮件未能获取，运行记录只推进到 "
+                           f"{st.session_state.run_summary['last_uid']}，下次运行将重新获取其后的邮件。", "warning")
             st.session_state.run_summary['emails_to_process_client'] = fetched_count
             append_log(f"客户端筛选后，总共获取待处理邮件数: {fetched_count}", "info")
 
-    except (IMAPClient.Abort, ConnectionResetError) as e: 
+    except (IMAP_ABORT, ConnectionResetError) as e: 
+        st.session_state.imap_client = None # Broken: reconnect on the next run
         append_log(f"IMAP连接错误: {e}。请检查网络或凭据后重试。", "error")
         raise 
     except Exception as e:
         append_log(f"邮件获取过程中发生意外错误: {e}", "error")
         import traceback
-        st.session_state.processing_log.append(traceback.format_exc())
+        append_log(traceback.format_exc(), "error")
         raise 
 
 def get_body(msg):
-    if msg.text_part:
-        charset = msg.text_part.charset or "utf-8"
-        return msg.text_part.get_payload().decode(charset, "ignore")
-    if msg.html_part:
-        charset = msg.html_part.charset or "utf-8"
-        html = msg.html_part.get_payload().decode(charset, "ignore")
-        return html2text(html)
+    part = msg.text_part
+    if part:
+        text = part.get_payload().decode(part.charset or "utf-8", "ignore")
+        if text.strip() or not msg.html_part: # Some senders ship an empty text/plain next to the real HTML
+            return text
+    part = msg.html_part
+    if part:
+        raw = part.get_payload()
+        html = raw.decode(part.charset or "utf-8", "ignore")
+        return html2text(html) if b"<" in raw else html # No markup: skip the HTML parser
     return ""
 
+def sniff_attachment_suffix(mime_type: str | None, blob: bytes) -> str | None:
+    """Guess a parseable suffix for an attachment whose filename doesn't tell: MIME type first, then magic bytes."""
+    suffix = ATTACHMENT_MIME_SUFFIXES.get((mime_type or "").lower())
+    if suffix:
+        return suffix
+    for magic, suffix in ATTACHMENT_MAGIC_SUFFIXES:
+        if blob.startswith(magic):
+            return suffix
+    return None
+
 def list_attachments(msg):
+    """Yield (filename, bytes) for attachments worth parsing.
+
+    A name without a recognised suffix gets one from sniff_attachment_suffix,
+    so everything downstream can go by suffix alone.
+    """
     for part in msg.mailparts:
         fn = getattr(part, "filename", None)
         if fn:
+            if (part.type or "").startswith("image/"): # Logos and signatures: never NAV data
+                append_log(f"    已跳过图片附件: {fn}", "info")
+                continue
+            suffix = pathlib.Path(fn).suffix.lower()
+            if suffix not in ATTACHMENT_SUFFIXES:
+                sniffed = None
+                if not suffix or suffix in (".dat", ".bin", ".tmp"): # Names that say nothing about the content
+                    payload = part.get_payload()
+                    sniffed = sniff_attachment_suffix(part.type, payload if isinstance(payload, bytes) else b"")
+                if sniffed not in ATTACHMENT_SUFFIXES: # PDFs without pdfminer, images, .p7s signatures...
+                    append_log(f"    已跳过非表格/文本附件: {fn}", "info")
+                    continue
+                append_log(f"    附件 {fn} 按内容识别为 {sniffed} 文件", "info")
+                fn = f"{fn}{sniffed}"
             payload_bytes = part.get_payload()
+            if type(payload_bytes) is bytes: # The usual case: already decoded bytes
+                yield fn, payload_bytes
+                continue
             if not isinstance(payload_bytes, bytes):
                 charset = part.charset or "utf-8"
                 try:
@@ -219,9 +700,386 @@ def list_attachments(msg):
                     continue
             yield fn, payload_bytes
 
+def split_text(text: str, max_chars: int, max_lines: int | None = None) -> list[str]:
+    """Split `text` on line boundaries into pieces of at most ~max_chars (and max_lines lines)."""
+    if len(text) <= max_chars and (max_lines is None or text.count("\n") < max_lines):
+        return [text]
+    segments, current, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        if current and (size + len(line) > max_chars or (max_lines is not None and len(current) >= max_lines)):
+            segments.append("".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line)
+    if current:
+        segments.append("".join(current))
+    return segments
+
+def compress_context(text: str, max_chars: int | None = None) -> str:
+    """Shrink prompt text without touching the figures: drop HTML remnants, replace
+    URLs/emails/phone numbers with [URL]/[EMAIL]/[PHONE] and collapse whitespace.
+
+    If still longer than `max_chars`, keep a `max_chars` window centred on the
+    first NAV keyword, or else the first and last half of it (NAV tables and
+    summary rows are usually near the top or the bottom).
+    """
+    text = HTML_REMNANT_RE.sub(" ", text)
+    text = URL_RE.sub("[URL]", text)
+    text = EMAIL_RE.sub("[EMAIL]", text)
+    text = PHONE_RE.sub("[PHONE]", text)
+    text = INLINE_SPACE_RE.sub(" ", text)
+    text = BLANK_LINES_RE.sub("\n\n", text).strip(" \r\n\u3000") # Not tabs: an empty first/last cell
+    if max_chars and len(text) > max_chars:
+        half = max_chars // 2
+        m = NAV_CONTENT_RE.search(text)
+        if m:
+            start = max(0, min(m.start() - half, len(text) - max_chars))
+            head = f"…(前略 {start} 字)…\n" if start else ""
+            tail = f"\n…(后略 {len(text) - start - max_chars} 字)…" if start + max_chars < len(text) else ""
+            text = f"{head}{text[start:start + max_chars]}{tail}"
+        else:
+            text = f"{text[:half]}\n…(中间省略 {len(text) - 2 * half} 字)…\n{text[-half:]}"
+    return text
+
+def read_attachment_table(fn: str, blob: bytes) -> pd.DataFrame | None:
+    """Return a .csv attachment, or all sheets of a spreadsheet, as one DataFrame; else None."""
+    suffix = pathlib.Path(fn).suffix.lower()
+    try:
+        if suffix == ".csv":
+            try:
+                return pd.read_csv(io.BytesIO(blob), encoding="utf-8")
+            except UnicodeDecodeError:
+                return pd.read_csv(io.BytesIO(blob), encoding="gbk", encoding_errors="ignore")
+        if suffix not in SPREADSHEET_SUFFIXES:
+            return None
+        with io.BytesIO(blob) as buf: # Closed right after parsing so the copy is freed
+            xls_content = pd.read_excel(buf, sheet_name=None, engine=EXCEL_READ_ENGINES[suffix])
+    except Exception: # Unreadable as a table: the caller sends it as text
+        return None
+    if isinstance(xls_content, dict): 
+        return pd.concat(xls_content.values(), ignore_index=True)
+    return xls_content
+
+def normalize_nav_header(header) -> str | None:
+    """Map a spreadsheet header such as "净值日期" or "单位净值(元)" onto a target field."""
+    key = re.sub(r"\s+|[（(].*?[）)]", "", str(header))
+    for field, aliases in NAV_HEADER_ALIASES.items():
+        if key in aliases:
+            return field
+    return None
+
+def date_from_names(*names: str) -> str:
+    """First valid full date (YYYY-MM-DD) found in any of `names`, else "".
+
+    >>> date_from_names("SQD546_202112净值.xlsx", "基金净值日报 2024年5月10日")
+    '2024-05-10'
+    >>> date_from_names("产品201234净值.xlsx", "SQD546_2024051.xlsx")
+    ''
+    """
+    for name in names:
+        for m in NAME_DATE_RE.finditer(name or ""):
+            year, month, day = m[1], m[2] or m[4], m[3] or m[5]
+            try:
+                return datetime.date(int(year), int(month), int(day)).strftime("%Y-%m-%d")
+            except ValueError: # e.g. "20241399": digits, not a date
+                continue
+    return ""
+
+def parse_structured_nav(table: pd.DataFrame, default_date: str = "") -> list[dict]:
+    """Read NAV rows straight from a table whose headers match ≥4 of the 5 target fields.
+
+    A table without a date column only qualifies when `default_date` (from the
+    filename or subject) is given. Returns [] when the headers don't match or
+    no row has a numeric NAV, so the caller falls back to GLM. NAV values come
+    back as floats.
+    """
+    mapping = {}
+    for col in table.columns:
+        field = normalize_nav_header(col)
+        if field and field not in mapping.values():
+            mapping[col] = field
+    if len(mapping) < 4:
+        return []
+    if "日期" not in mapping.values() and not default_date: # Rows keyed ("", code) would lose the date
+        return []
+
+    table = table[list(mapping)].rename(columns=mapping)
+    for field in NAV_HEADER_ALIASES:
+        if field not in table:
+            table[field] = default_date if field == "日期" else ""
+    table = coerce_nav_columns(table).dropna(subset=["单位净值", "累计净值"], how="all") # Notes/subtotals
+    table["日期"] = table["日期"].map(
+        lambda v: v.strftime("%Y-%m-%d") if isinstance(v, datetime.date) and not pd.isna(v) else v)
+    table["基金代码"] = table["基金代码"].map(
+        lambda v: str(int(v)).zfill(6) if isinstance(v, (int, float)) and v == v and v == int(v) else v) # Excel drops leading zeros
+    return table[list(NAV_HEADER_ALIASES)].fillna("").to_dict("records")
+
+def coerce_nav_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert 单位净值/累计净值 to float in one vectorized pass.
+
+    Blank values become NaN; rows holding a non-blank value that does not parse
+    as a number are dropped.
+    """
+    bad = pd.Series(False, index=df.index)
+    for col in ("单位净值", "累计净值"):
+        raw = df[col].astype(str).str.replace(",", "", regex=False).str.strip()
+        blank = df[col].isna() | raw.isin(["", "None", "nan"])
+        df[col] = pd.to_numeric(raw.where(~blank), errors="coerce")
+        bad |= df[col].isna() & ~blank
+    return df[~bad]
+
+def looks_like_text(text: str) -> bool:
+    """True if `text` is long enough and mostly printable (see TEXT_MIN_CHARS, TEXT_PRINTABLE_RATIO)."""
+    if len(text) <= TEXT_MIN_CHARS:
+        return False
+    printable = sum(1 for c in text if c.isprintable() or c in "\n\r\t")
+    return printable / len(text) > TEXT_PRINTABLE_RATIO
+
+def attachment_to_segments(fn: str, blob: bytes, table: pd.DataFrame | None = None) -> list[str]:
+    """Render an attachment as prompt-sized text segments, entirely in memory.
+
+    Spreadsheets (`table`, from read_attachment_table) keep only NAV-looking
+    columns and are split into chunks of ATTACH_SEGMENT_ROWS rows (each with
+    its header) when the CSV would exceed ATTACH_SEGMENT_CHARS or that many rows.
+    """
+    suffix = pathlib.Path(fn).suffix.lower()
+    if table is None and suffix in SPREADSHEET_SUFFIXES: # Unreadable workbook: its bytes are not text
+        append_log(f"    附件 {fn} 无法作为表格读取，已跳过", "warning")
+        return []
+    if table is None and suffix == ".pdf":
+        try:
+            from pdfminer.high_level import extract_text as pdf_extract_text # type: ignore
+            text = pdf_extract_text(io.BytesIO(blob))
+        except Exception as e:
+            append_log(f"    无法提取PDF附件 {fn} 的文本: {e}", "warning")
+            return []
+        text = compress_context(text)
+        if not looks_like_text(text): # Scanned PDFs have no text layer
+            append_log(f"    附件: {fn} (非文本)，已跳过", "info")
+            return []
+        return split_text(text, ATTACH_SEGMENT_CHARS, ATTACH_SEGMENT_ROWS)
+    if table is None: # Not a spreadsheet: treat as text
+        try:
+            text = blob.decode("utf-8")
+        except UnicodeDecodeError:
+            text = blob.decode("gbk", "ignore")
+        if suffix in (".html", ".htm"):
+            text = html2text(text)
+        text = compress_context(text)
+        if not looks_like_text(text): # Binary blob behind a text name/MIME type, or an empty file
+            append_log(f"    附件: {fn} (非文本)，已跳过", "info")
+            return []
+        return split_text(text, ATTACH_SEGMENT_CHARS, ATTACH_SEGMENT_ROWS)
+
+    nav_cols = [c for c in table.columns if NAV_COLUMN_RE.search(str(c))]
+    if nav_cols: # Otherwise (e.g. title rows above the table) keep every column
+        table = table[nav_cols]
+    table = table.dropna(how="all").dropna(axis=1, how="all") # Spacer rows / empty columns cost tokens only
+    csv_text = table.to_csv(index=False, header=True)
+    if len(csv_text) <= ATTACH_SEGMENT_CHARS and len(table) <= ATTACH_SEGMENT_ROWS:
+        return [csv_text]
+    return [table.iloc[k:k + ATTACH_SEGMENT_ROWS].to_csv(index=False, header=True)
+            for k in range(0, len(table), ATTACH_SEGMENT_ROWS)]
+
+def prepare_attachment(fn: str, blob: bytes, subj: str = "") -> tuple[list[dict], list[str]]:
+    """Parse one attachment: (structured NAV rows, []) if it is a NAV table, else ([], text segments for GLM)."""
+    table = read_attachment_table(fn, blob)
+    if table is not None:
+        structured = parse_structured_nav(table, date_from_names(fn, subj))
+        if structured: # Headers already match the target fields: no GLM needed
+            return structured, []
+    return [], attachment_to_segments(fn, blob, table)
+
+def parse_labelled_nav(body: str) -> tuple[list[dict], str]:
+    """Template parser for bodies that label every field (see LABELLED_NAV_RE).
+
+    Returns the rows found and the body with those matches cut out, so any
+    NAV text the template missed can still go to GLM. A record missing a field
+    is left in the rest rather than borrowing the next record's values:
+
+    >>> rows, rest = parse_labelled_nav(
+    ...     "基金名称：甲基金 基金代码：SQD546 净值日期：2024-05-10 单位净值：1.1000\\n"
+    ...     "基金名称：乙基金 基金代码：SQD547 净值日期：2024-05-10 单位净值：2.1000 累计净值：2.5000")
+    >>> [(r["基金代码"], r["单位净值"], r["累计净值"]) for r in rows]
+    [('SQD547', '2.1000', '2.5000')]
+    >>> "SQD546" in rest
+    True
+    """
+    items, rest, pos = [], [], 0
+    for m in LABELLED_NAV_RE.finditer(body):
+        year, month, day = re.findall(r"\d+", m["date"])
+        items.append({"日期": f"{year}-{int(month):02d}-{int(day):02d}", "基金名称": m["name"],
+                      "基金代码": m["code"], "单位净值": m["unit"], "累计净值": m["acc"]})
+        rest.append(body[pos:m.start()])
+        pos = m.end()
+    rest.append(body[pos:])
+    return items, "".join(rest)
+
+# Body parsers by sender domain, tried before GLM: each takes the body and returns
+# (rows, unparsed rest of the body). Register a custodian's template here, e.g.
+# PARSERS["cmbchina.com"] = parse_labelled_nav; unregistered senders go straight to GLM.
+PARSERS = {}
+
+def queue_email(rows: dict, glm_jobs: list, email_idx: int, subj: str, sender_name: str,
+                sender_email: str, body: str, attachment_futures: list):
+    """Wait for one email's attachments to be parsed, keep structured rows and queue its GLM prompts.
+
+    One prompt carries the body plus as many attachments as fit the token
+    budget and ATTACH_SEGMENT_ROWS lines; only the overflow spills into further
+    calls (each repeating the body).
+    """
+    parser = PARSERS.get(sender_email.rpartition("@")[2].lower())
+    template_rows, body_rest = parser(body) if parser else ([], body)
+    body_done = False
+    if template_rows:
+        add_rows(rows, template_rows, subj, sender_email, sender_name)
+        body_done = not NAV_CONTENT_RE.search(body_rest)
+        if body_done:
+            append_log(f"    [{email_idx}] 正文按模板解析到 {len(template_rows)} 行数据 (跳过GLM)", "info")
+            body = "(正文中的净值数据已单独解析)"
+        else: # Only what the template did not cover is left for GLM
+            append_log(f"    [{email_idx}] 正文按模板解析到 {len(template_rows)} 行数据，其余正文交由GLM", "info")
+            body = body_rest
+
+    payloads_to_process = [] # (source name, attachment text)
+    for fn, future in attachment_futures:
+        structured, attach_segments = future.result()
+        if structured:
+            append_log(f"    [{email_idx}] 附件 {fn} 为结构化净值表，直接解析到 {len(structured)} 行数据 (跳过GLM)", "info")
+            add_rows(rows, structured, subj, sender_email, sender_name)
+            continue
+        for k, attach_text in enumerate(attach_segments, 1):
+            source_name = fn if len(attach_segments) == 1 else f"{fn} (第{k}/{len(attach_segments)}段)"
+            payloads_to_process.append((source_name, attach_text))
+    if body_done and not payloads_to_process:
+        return
+    # Decided per email, not per batch: later split_text segments carry no header line, so they
+    # are NAV data only because of the subject, body or first segment they belong with
+    if not (NAV_CONTENT_RE.search(subj) or template_rows or NAV_CONTENT_RE.search(body)
+            or any(NAV_CONTENT_RE.search(attach_text) for _, attach_text in payloads_to_process)):
+        append_log(f"    [{email_idx}] 主题、正文及附件中均未出现净值相关关键词，跳过GLM", "info")
+        return
+
+    prompt_header = (
+        f"邮件主题: {subj}\n"
+        f"发件人: {sender_name} <{sender_email}>\n\n"
+        f"【邮件正文】\n{body}\n\n"
+    )
+    batches = [[]]
+    batch_chars, batch_lines = len(prompt_header), 0
+    for k, (source_name, attach_text) in enumerate(payloads_to_process, 1):
+        part = f"【附件{k}: {source_name}】\n{attach_text}\n\n"
+        part_lines = attach_text.count("\n") # ≈ rows the answer has to list: bounds the output, not just the input
+        if batches[-1] and ((batch_chars + len(part)) // 3 > GLM_PROMPT_TOKEN_BUDGET
+                            or batch_lines + part_lines > ATTACH_SEGMENT_ROWS):
+            batches.append([])
+            batch_chars, batch_lines = len(prompt_header), 0
+        batches[-1].append((source_name, part))
+        batch_chars += len(part)
+        batch_lines += part_lines
+    for batch_idx, batch in enumerate(batches):
+        sources = ([] if batch_idx else ["正文"]) + [source_name for source_name, _ in batch]
+        prompt = prompt_header + "".join(part for _, part in batch)
+        glm_jobs.append((email_idx, " + ".join(sources), subj, sender_name, sender_email, prompt))
+
+def add_rows(rows: dict, items: list[dict], subj: str, sender_email: str, sender_name: str):
+    """Merge parsed items into `rows`, keyed by (日期, 基金代码) so a fund's NAV for a day is kept once.
+
+    Later items win. Funds without a code fall back to their name for the key.
+    Rows are stored as tuples in COLS order, ready for pd.DataFrame(columns=COLS).
+    """
+    for item in items:
+        date, name, code = item.get("日期", ""), item.get("基金名称", ""), item.get("基金代码", "")
+        rows[(str(date), str(code or name))] = (
+            date, name, code, item.get("单位净值", ""), item.get("累计净值", ""),
+            subj, sender_email, sender_name)
+
+def glm_cache_connect() -> sqlite3.Connection:
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(GLM_CACHE_FILE, timeout=30)
+    conn.execute("CREATE TABLE IF NOT EXISTS glm_cache (key TEXT PRIMARY KEY, ts INTEGER, response TEXT)")
+    return conn
+
+def glm_cache_get(key: str) -> str | None:
+    try:
+        with GLM_CACHE_LOCK, contextlib.closing(glm_cache_connect()) as conn, conn:
+            row = conn.execute("SELECT response, ts FROM glm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if GLM_CACHE_TTL_DAYS is not None and row[1] < time.time() - GLM_CACHE_TTL_DAYS * 86400:
+                conn.execute("DELETE FROM glm_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE glm_cache SET ts = ? WHERE key = ?", (int(time.time()), key))
+            return row[0]
+    except sqlite3.Error as e:
+        append_log(f"    读取GLM缓存失败: {e}", "warning")
+        return None
+
+def glm_cache_put(key: str, response: str):
+    try:
+        with GLM_CACHE_LOCK, contextlib.closing(glm_cache_connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO glm_cache (key, ts, response) VALUES (?, ?, ?)",
+                         (key, int(time.time()), response))
+            conn.execute("DELETE FROM glm_cache WHERE key NOT IN "
+                         "(SELECT key FROM glm_cache ORDER BY ts DESC LIMIT ?)", (GLM_CACHE_MAX_ENTRIES,))
+            if GLM_CACHE_TTL_DAYS is not None:
+                conn.execute("DELETE FROM glm_cache WHERE ts < ?", (int(time.time()) - GLM_CACHE_TTL_DAYS * 86400,))
+    except sqlite3.Error as e:
+        append_log(f"    写入GLM缓存失败: {e}", "warning")
+
+def read_glm_stream(res) -> tuple[str, bool]:
+    """Accumulate a streamed (SSE) GLM answer up to the close of its top-level JSON value.
+
+    Brackets inside JSON strings and inside a leading <think>…</think> block are
+    ignored, so only the closing bracket of the answer itself ends the answer.
+    Returns (text, complete): complete is False when the stream ended before
+    the JSON value closed or was cut off at max_tokens.
+    """
+    buffer, pos, depth, in_string, escaped = "", 0, 0, False, False
+    closed, truncated = False, False
+    for line in res.iter_lines():
+        if not line.startswith(b"data:"):
+            continue
+        data = line[len(b"data:"):].strip()
+        if data == b"[DONE]": # The body ends right after; let iter_lines run out so requests marks it consumed
+            continue
+        choice = json_loads(data)["choices"][0]
+        truncated = truncated or choice.get("finish_reason") == "length"
+        if closed: # Read on to [DONE] so the connection goes back to the pool instead of being dropped
+            continue
+        buffer += choice.get("delta", {}).get("content") or ""
+        if depth == 0: # Not inside the answer yet: skip over any reasoning block
+            think_start = buffer.find("<think>")
+            if think_start != -1:
+                think_end = buffer.find("</think>", think_start)
+                if think_end == -1:
+                    continue
+                pos = max(pos, think_end + len("</think>"))
+        while pos < len(buffer):
+            ch = buffer[pos]
+            pos += 1
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch in "[{":
+                depth += 1
+            elif depth and ch in "]}":
+                depth -= 1
+                if depth == 0:
+                    closed = True
+                    buffer = buffer[:pos]
+                    break
+            elif depth and ch == '"':
+                in_string = True
+    return buffer, closed and not truncated
+
 def glm(prompt:str)->str:
     system_prompt = """您是一位提取金融数据的专家。请从提供的文本（邮件主题、正文和附件）中识别并提取关于公募基金或私募基金的净值信息。
-请将信息以 JSON 对象数组的形式返回。每个对象应代表一只独立的基金，并精确包含以下字段：
+请将信息以一个 JSON 对象的形式返回，其 "funds" 字段为对象数组。数组中每个对象应代表一只独立的基金，并精确包含以下字段：
 - "日期": 基金净值的日期，格式为YYYY-MM-DD，来源于文本内容。
 - "基金名称": 基金的名称。
 - "基金代码": 基金的字母数字代码。
@@ -231,101 +1089,124 @@ def glm(prompt:str)->str:
 重要提示：
 - 仅包含明确的基金净值数据条目。
 - 如果列出了多只基金，请为每只基金创建一个单独的 JSON 对象。
-- 如果在文本中未找到有效的基金净值数据，请返回一个空的 JSON 数组：[]。
-- **您的回复必须严格遵守输出格式。您的回复只能包含一个 JSON 对象数组，不能有任何其他文字、解释、注释或思考过程。绝对不要使用 `<think>` 或任何类似的标签。如果找不到数据，请返回空的 JSON 数组 `[]`。任何偏离此 JSON-only 格式的输出都将被视为失败。**
+- 如果在文本中未找到有效的基金净值数据，请返回 "funds" 为空数组的对象：{"funds": []}。
+- **您的回复必须严格遵守输出格式。您的回复只能包含一个 JSON 对象，不能有任何其他文字、解释、注释或思考过程。绝对不要使用 `<think>` 或任何类似的标签。如果找不到数据，请返回 `{"funds": []}`。任何偏离此 JSON-only 格式的输出都将被视为失败。**
 - 确保“单位净值”和“累计净值”的值是数字。
 - 请仔细准确识别基金名称和代码，避免提取通用文本或文件名。
 - “日期”应该是与净值相关的特定日期，除非明确说明是净值日期，否则不一定是邮件日期或报告生成日期。
 
 期望的单个基金输出示例：
-[
-  {
-    "日期": "2025-05-26",
-    "基金名称": "九招真格量化套利一号私募证券投资基金",
-    "基金代码": "SQD546",
-    "单位净值": 1.0580,
-    "累计净值": 1.5053
-  }
-]
+{
+  "funds": [
+    {
+      "日期": "2025-05-26",
+      "基金名称": "九招真格量化套利一号私募证券投资基金",
+      "基金代码": "SQD546",
+      "单位净值": 1.0580,
+      "累计净值": 1.5053
+    }
+  ]
+}
 无数据时输出示例：
-[]
+{"funds": []}
 """
-    try:
-        res = requests.post(
-            GLM_URL,
-            json={
-                "model": MODEL,
-                "messages":[
-                    {"role":"system", "content": system_prompt},
-                    {"role":"user","content":prompt}],
-                "temperature":0.2,
-                "max_tokens":32000,
-                "stream":False},
-            headers={"Authorization":f"Bearer {GLM_KEY}"},
-            timeout=300) 
-        res.raise_for_status()
-        return res.json()["choices"][0]["message"]["content"]
-    except requests.exceptions.RequestException as e:
-        append_log(f"    GLM API 请求失败: {e}", "error")
-        return "[]" 
-    except (KeyError, IndexError, json.JSONDecodeError) as e:
-        response_text = res.text if 'res' in locals() else "N/A (response object not available)"
-        append_log(f"    GLM API 响应格式异常或非有效JSON: {e} - 响应内容: {response_text[:200]}", "error")
-        return "[]"
+    # Exact-match cache: same model + instructions + email content → same answer
+    cache_key = hashlib.sha256(f"{MODEL}\n{system_prompt}\n{prompt}".encode("utf-8")).hexdigest()
+    cached = glm_cache_get(cache_key)
+    if cached is not None:
+        append_log("    GLM缓存命中，跳过API调用", "info")
+        return cached
+    payload = {
+        "model": MODEL,
+        "messages":[
+            {"role":"system", "content": system_prompt},
+            {"role":"user","content":prompt}],
+        "temperature":0.2,
+        "max_tokens":GLM_MAX_TOKENS,
+        "stream":True}
+    if GLM_RESPONSE_FORMAT:
+        payload["response_format"] = GLM_RESPONSE_FORMAT
+    prompt_tokens = (len(system_prompt) + len(prompt)) // 3
+    for attempt in range(1, GLM_MAX_ATTEMPTS + 1):
+        GLM_LIMITER.acquire(prompt_tokens)
+        overloaded, retry_after = False, None
+        try:
+            with GLM_SESSION.post(GLM_URL, data=json_dumps(payload), timeout=GLM_TIMEOUT, stream=True) as res:
+                if res.status_code in GLM_RETRY_STATUS:
+                    overloaded, retry_after = True, res.headers.get("Retry-After")
+                res.raise_for_status()
+                content, complete = read_glm_stream(res)
+            if not complete: # Truncated or empty: not worth caching, and not parseable anyway
+                append_log(f"    GLM API 回复不完整 (未返回完整JSON或超出 max_tokens): {content[:200]}", "error")
+                return "[]"
+            glm_cache_put(cache_key, content)
+            return content
+        except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            retryable = overloaded or not isinstance(e, requests.exceptions.HTTPError)
+            if not retryable or attempt == GLM_MAX_ATTEMPTS:
+                append_log(f"    GLM API 请求失败: {e}", "error")
+                return "[]"
+            # Full-jitter exponential backoff; honour the server's Retry-After when given
+            delay = max(1.0, random.uniform(0, min(30, 2 ** attempt)))
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            append_log(f"    GLM API 请求失败 (第{attempt}次): {e}，{delay:.1f} 秒后重试", "warning")
+        except requests.exceptions.RequestException as e:
+            append_log(f"    GLM API 请求失败: {e}", "error")
+            return "[]"
+        except (KeyError, IndexError, json.JSONDecodeError) as e:
+            response_text = getattr(e, "doc", None) or "N/A"
+            append_log(f"    GLM API 响应格式异常或非有效JSON: {e} - 响应内容: {str(response_text)[:200]}", "error")
+            return "[]"
+        finally:
+            GLM_LIMITER.release(overloaded)
+        time.sleep(delay)
 
-def parse_glm(txt:str):
-    try:
-        cleaned_txt = txt.strip()
-        json_start_index = -1
-        first_brace = cleaned_txt.find('{')
-        first_bracket = cleaned_txt.find('[')
-
-        if first_brace != -1 and first_bracket != -1:
-            json_start_index = min(first_brace, first_bracket)
-        elif first_brace != -1:
-            json_start_index = first_brace
-        elif first_bracket != -1:
-            json_start_index = first_bracket
-        
-        if json_start_index > 0:
-            preceding_text = cleaned_txt[:json_start_index]
-            append_log(f"    已剥离GLM响应中JSON内容之前的文本: '{preceding_text[:100].strip()}...'", "info")
-            cleaned_txt = cleaned_txt[json_start_index:]
-        elif json_start_index == -1 :
-            append_log(f"    GLM输出不包含有效的JSON起始字符([或{{)，或者可能仅为思考过程: '{cleaned_txt[:200].strip()}...'", "warning")
-            return []
+def glm_batch(prompts: list[str]):
+    """Run glm() over prompts on a thread pool, yielding (prompt index, answer) as each call completes.
 
-        if cleaned_txt.startswith("```json"):
-            cleaned_txt = cleaned_txt[len("```json"):].strip()
-        elif cleaned_txt.startswith("```"):
-            cleaned_txt = cleaned_txt[len("```"):].strip()
-        if cleaned_txt.endswith("```"):
-            cleaned_txt = cleaned_txt[:-len("```")].strip()
+    Completion order, not prompt order: one slow call no longer holds back
+    the answers (and progress) of every call queued after it.
+    """
+    with ThreadPoolExecutor(max_workers=GLM_CONCURRENCY, initializer=add_script_run_ctx,
+                            initargs=(None, get_script_run_ctx())) as executor:
+        futures = {executor.submit(glm, prompt): k for k, prompt in enumerate(prompts)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
 
-        if not cleaned_txt:
-            return []
-        
-        data = json.loads(cleaned_txt)
+def parse_glm(txt:str):
+    try:
+        data = cleaned_txt = None
+        if txt.lstrip()[:1] in ("{", "["): # JSON mode usually returns the bare object: no scanning needed
+            try:
+                data, cleaned_txt = json_loads(txt), txt
+            except json.JSONDecodeError:
+                pass
+        if cleaned_txt is None: # Reasoning, code fences or chatter around the JSON
+            txt = THINK_RE.sub("", txt).lstrip()
+            m = JSON_EXTRACT_RE.search(txt)
+            if m is None:
+                append_log(f"    GLM输出不包含有效的JSON起始字符([或{{)，或者可能仅为思考过程: '{txt[:200].strip()}...'", "warning")
+                return []
+            preceding_text = txt[:m.start()].strip()
+            if preceding_text:
+                append_log(f"    已剥离GLM响应中JSON内容之前的文本: '{preceding_text[:100]}...'", "info")
+            cleaned_txt = m.group(1) or m.group(2)
+            data = json_loads(cleaned_txt)
         parsed_items = []
-        expected_keys = {"日期", "基金名称", "基金代码", "单位净值", "累计净值"}
 
+        if isinstance(data, dict) and isinstance(data.get("funds"), list): # JSON-mode wrapper
+            data = data["funds"]
         items_to_process = data if isinstance(data, list) else [data] if isinstance(data, dict) else []
         if not items_to_process and data:
              append_log(f"    GLM输出(剥离后)是有效的JSON，但不是列表或字典格式: {cleaned_txt[:200]}", "warning")
 
         for item in items_to_process:
-            if isinstance(item, dict):
-                if expected_keys.issubset(item.keys()):
-                    try:
-                        item["单位净值"] = float(str(item["单位净值"]).replace(',','')) if item.get("单位净值") is not None else None
-                        item["累计净值"] = float(str(item["累计净值"]).replace(',','')) if item.get("累计净值") is not None else None
-                        parsed_items.append(item)
-                    except (ValueError, TypeError):
-                        append_log(f"    GLM项目已跳过(净值无法转换为浮点数): {str(item)[:100]}", "warning")
-                else:
-                    append_log(f"    GLM项目已跳过(缺少预期键): {str(item)[:100]}", "warning")
-            else:
-                append_log(f"    GLM项目已跳过(非字典格式): {str(item)[:100]}", "warning")
+            try:
+                parsed_items.append(validate_nav_item(item)) # NAV floats are converted in bulk by coerce_nav_columns
+            except NavItemInvalid as e:
+                append_log(f"    GLM项目已跳过({e}): {str(item)[:100]}", "warning")
         return parsed_items
 
     except json.JSONDecodeError:
@@ -335,22 +1216,70 @@ def parse_glm(txt:str):
         append_log(f"    解析GLM输出时发生意外错误: {e}。原始开头: '{txt[:100].strip()}...'", "error")
         return []
 
+def update_nav_store(df: pd.DataFrame) -> pd.DataFrame:
+    """Merge this run's rows into today's parquet store and return all of today's rows."""
+    df = df.copy()
+    text_cols = [c for c in COLS if c not in ("单位净值", "累计净值")]
+    df[text_cols] = df[text_cols].fillna("").astype(str) # Parquet needs one type per column
+    try:
+        if NAV_STORE.exists():
+            # Same identity as add_rows: one row per (日期, 基金代码 or 基金名称); this run's values win
+            df = pd.concat([pd.read_parquet(NAV_STORE), df], ignore_index=True)
+            fund_key = df["基金代码"].where(df["基金代码"] != "", df["基金名称"])
+            df = df[~pd.DataFrame({"日期": df["日期"], "key": fund_key}).duplicated(keep="last")]
+            df = df.reset_index(drop=True)
+        df.to_parquet(NAV_STORE, index=False, compression="zstd")
+    except ImportError as e:
+        append_log(f"    未安装Parquet引擎 (pyarrow)，无法维护当日存档: {e}。Excel仅包含本次运行的数据。", "warning")
+    return df
+
+def write_xlsx(df: pd.DataFrame, target):
+    """Write `df` as SHEET of a new workbook at `target` (a path or file object)."""
+    if EXCEL_WRITE_ENGINE == "xlsxwriter":
+        # constant_memory flushes each row as it is written; pandas' to_excel writes
+        # column by column, which this mode cannot take, so rows are written directly.
+        workbook = xlsxwriter.Workbook(target, {"constant_memory": True})
+        worksheet = workbook.add_worksheet(SHEET)
+        worksheet.write_row(0, 0, list(df.columns))
+        for r, row in enumerate(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None), 1):
+            worksheet.write_row(r, 0, row)
+        workbook.close()
+    else:
+        # Write-only workbooks stream rows to the file instead of holding every cell in memory
+        import openpyxl
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Font
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet(SHEET)
+        bold_font = Font(bold=True) # Same look as pandas' header row; one instance shared by every header cell
+        header = []
+        for name in df.columns:
+            cell = WriteOnlyCell(worksheet, value=name)
+            cell.font = bold_font
+            header.append(cell)
+        worksheet.append(header)
+        for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+            worksheet.append(row)
+        workbook.save(target)
+
 def run_processing(process_all_mode: bool = False):
     st.session_state.processing_log = [] 
     st.session_state.processed_df = None
+    st.session_state.processed_xlsx = None
     st.session_state.run_summary = {}
     
     LOG_DIR.mkdir(parents=True, exist_ok=True) 
     
-    last_run_dt_utc = None
+    last_run_state = None
     if process_all_mode:
         append_log("开始处理收件箱中的所有邮件...", "info") # MODIFIED LOG MESSAGE
-        # last_run_dt_utc remains None, so fetch_mail uses 'ALL' criteria via process_all_emails_flag
+        # last_run_state remains None, so fetch_mail uses 'ALL' criteria via process_all_emails_flag
     else:
         append_log("开始处理新邮件...", "info")
-        last_run_dt_utc = get_last_run_datetime() 
+        last_run_state = get_last_run_state() 
     
-    rows = []
+    rows = {} # (日期, 基金代码) → row tuple in COLS order
+    glm_jobs = [] # (email index, source name, subject, sender name, sender email, prompt)
     progress_bar = st.progress(0.0)
     status_text = st.empty() 
 
@@ -358,7 +1287,7 @@ def run_processing(process_all_mode: bool = False):
     
     try:
         mail_fetch_iterator = fetch_mail(
-            last_run_utc_dt=last_run_dt_utc, 
+            last_run_state=last_run_state, 
             default_days_lookback=30, 
             process_all_emails_flag=process_all_mode, # PASSING THE NEW FLAG
             progress_bar=progress_bar,
@@ -367,104 +1296,98 @@ def run_processing(process_all_mode: bool = False):
         
         if mail_fetch_iterator:
             email_processing_status = st.empty()
-            for loop_idx, msg in enumerate(mail_fetch_iterator, 1):
-                actual_emails_processed_count = loop_idx 
-                if msg is None: continue
+            pending = collections.deque() # queue_email() arguments of emails whose attachments are parsing
+            seen_emails = {} # content hash → index of the first email with that content
+            # Attachments are parsed in the background while the next messages download
+            with ThreadPoolExecutor(max_workers=ATTACH_WORKERS, initializer=add_script_run_ctx,
+                                    initargs=(None, get_script_run_ctx())) as attach_executor:
+                for loop_idx, msg in enumerate(mail_fetch_iterator, 1):
+                    actual_emails_processed_count = loop_idx 
+                    if msg is None: continue
+                    if not msg.mailparts: # No text, no HTML, no attachments: nothing to parse
+                        append_log(f"\n[{actual_emails_processed_count}] 邮件无正文和附件，已跳过: {msg.get_subject() or '(无主题)'}", "info")
+                        continue
 
-                sender_addresses = msg.get_addresses("from")
-                if sender_addresses:
-                    sender_name, sender_email = sender_addresses[0]
-                else:
-                    sender_name, sender_email = "未知发件人", "unknown@example.com"
-
-                subj = msg.get_subject() or "(无主题)"
-                body = get_body(msg)
-                atts = list(list_attachments(msg)) 
-
-                log_msg = (f"\n[{actual_emails_processed_count}] 正在处理: {subj}\n"
-                           f"    发件人: {sender_name} <{sender_email}>\n"
-                           f"    附件数 ({len(atts)}): {[fn for fn,_ in atts]}")
-                append_log(log_msg)
-                email_processing_status.text(f"正在分析邮件 {actual_emails_processed_count}: {subj[:50]}...")
-
-                payloads_to_process = [(None, b"")] 
-                payloads_to_process.extend(atts)
-
-                for fn, blob in payloads_to_process:
-                    attach_text = "(无相关文本内容)"
-                    source_name = "正文"
-
-                    if fn: 
-                        source_name = fn
-                        temp_file_path = None
-                        try:
-                            with tempfile.NamedTemporaryFile(delete=False, suffix=pathlib.Path(fn).suffix) as tmp:
-                                tmp.write(blob)
-                                temp_file_path = tmp.name
-                            
-                            try:
-                                xls_content = pd.read_excel(temp_file_path, sheet_name=None)
-                                if isinstance(xls_content, dict): 
-                                    combined_df = pd.concat(xls_content.values(), ignore_index=True)
-                                else: 
-                                    combined_df = xls_content
-                                attach_text = combined_df.to_csv(index=False, header=True)
-                            except Exception: 
-                                try:
-                                    attach_text = blob.decode("utf-8", "ignore")
-                                except UnicodeDecodeError:
-                                    attach_text = blob.decode("gbk", "ignore") 
-                                except Exception:
-                                    attach_text = "(二进制文件或无法识别编码)"
-                        except Exception as e_file:
-                            attach_text = f"(附件处理错误: {e_file})"
-                            append_log(f"    处理附件 {fn} 时出错: {e_file}", "warning")
-                        finally:
-                            if temp_file_path and pathlib.Path(temp_file_path).exists():
-                                pathlib.Path(temp_file_path).unlink()
-                        
-                    prompt_context = f"【邮件正文】\n{body}\n\n"
-                    if fn: 
-                        prompt_context += f"【附件: {fn}】\n{attach_text}"
-
-                    prompt = (
-                        f"邮件主题: {subj}\n"
-                        f"发件人: {sender_name} <{sender_email}>\n\n"
-                        f"{prompt_context}"
-                    )
-                    
-                    ans = glm(prompt) 
-                    parsed = parse_glm(ans) 
+                    sender_addresses = msg.get_addresses("from")
+                    if sender_addresses:
+                        sender_name, sender_email = sender_addresses[0]
+                    else:
+                        sender_name, sender_email = "未知发件人", "unknown@example.com"
 
-                    if parsed:
-                        append_log(f"    GLM从 {source_name} 解析到 {len(parsed)} 行数据", "info")
-                        for item in parsed:
-                            row = {c: "" for c in COLS}
-                            row.update(item) 
-                            row.update({
-                                "原邮件名": subj,
-                                "发件人": sender_email,
-                                "发件机构": sender_name 
-                            })
-                            rows.append(row)
+                    subj = msg.get_subject() or "(无主题)"
+                    body = compress_context(get_body(msg), BODY_MAX_CHARS)
+                    atts = list(list_attachments(msg)) 
+
+                    log_msg = (f"\n[{actual_emails_processed_count}] 正在处理: {subj}\n"
+                               f"    发件人: {sender_name} <{sender_email}>\n"
+                               f"    附件数 ({len(atts)}): {[fn for fn,_ in atts]}")
+                    append_log(log_msg)
+                    if ui_update_due(actual_emails_processed_count,
+                                     st.session_state.run_summary.get('emails_to_download', 0)):
+                        email_processing_status.text(f"正在分析邮件 {actual_emails_processed_count}: {subj[:50]}...")
+
+                    # The same notice often arrives through several distribution lists: identical
+                    # subject, body and attachments yield identical rows, so parse and prompt it once.
+                    digests = [hashlib.sha256(blob).digest() for _, blob in atts]
+                    email_hash = hashlib.sha256(
+                        b"\0".join([subj.encode("utf-8", "ignore"), body.encode("utf-8", "ignore")]
+                                   + sorted(set(digests)))).digest()
+                    if email_hash in seen_emails:
+                        append_log(f"    与第 {seen_emails[email_hash]} 封邮件内容相同，跳过解析与GLM调用", "info")
+                        continue
+                    seen_emails[email_hash] = actual_emails_processed_count
+
+                    attachment_futures, seen_digests = [], set()
+                    for (fn, blob), digest in zip(atts, digests):
+                        if digest in seen_digests: # Same file attached twice (e.g. forwarded with its original)
+                            append_log(f"    附件 {fn} 与本邮件中已有附件内容相同，已跳过", "info")
+                            continue
+                        seen_digests.add(digest)
+                        attachment_futures.append((fn, attach_executor.submit(prepare_attachment, fn, blob, subj)))
+                    del atts
+                    pending.append((actual_emails_processed_count, subj, sender_name, sender_email,
+                                    body, attachment_futures))
+                    # Only block on the oldest email once the pipeline is full
+                    while pending and (len(pending) > ATTACH_PIPELINE_DEPTH or
+                                       all(future.done() for _, future in pending[0][-1])):
+                        queue_email(rows, glm_jobs, *pending.popleft())
+                while pending:
+                    queue_email(rows, glm_jobs, *pending.popleft())
+
+            # GLM calls are I/O-bound: fan them out and parse each answer as it arrives
+            if glm_jobs:
+                email_processing_status.text(f"正在并发调用GLM分析 {len(glm_jobs)} 段内容...")
+                parsed_by_job = [None] * len(glm_jobs)
+                for done_count, (job_idx, ans) in enumerate(glm_batch([job[-1] for job in glm_jobs]), 1):
+                    email_idx, source_name = glm_jobs[job_idx][:2]
+                    if ui_update_due(done_count, len(glm_jobs)):
+                        email_processing_status.text(f"GLM分析进度: {done_count}/{len(glm_jobs)}")
+                    parsed_by_job[job_idx] = parse_glm(ans)
+
+                    if parsed_by_job[job_idx]:
+                        append_log(f"    [{email_idx}] GLM从 {source_name} 解析到 {len(parsed_by_job[job_idx])} 行数据", "info")
                     else:
-                        append_log(f"    未能从 {source_name} 解析到数据 (或解析失败)", "info")
+                        append_log(f"    [{email_idx}] 未能从 {source_name} 解析到数据 (或解析失败)", "info")
+                # Merge in job (= mail) order so the later email still wins a (日期, 基金代码) clash
+                for (_, _, subj, sender_name, sender_email, _), parsed in zip(glm_jobs, parsed_by_job):
+                    if parsed:
+                        add_rows(rows, parsed, subj, sender_email, sender_name)
             email_processing_status.text(f"邮件分析完成。已处理 {actual_emails_processed_count} 封邮件。")
         
         if progress_bar: progress_bar.progress(1.0) 
         if status_text: status_text.empty() 
 
-    except (IMAPClient.Abort, ConnectionResetError) as e_imap: 
-        append_log(f"由于连接错误，IMAP处理已中止: {e_imap}", "error")
+    # No save_current_run_state() on these paths: nothing fetched so far has had its rows
+    # written, so the next run must start again from the last saved UID
+    except (IMAP_ABORT, ConnectionResetError) as e_imap: 
+        append_log(f"由于连接错误，IMAP处理已中止: {e_imap}。运行记录未更新，下次将重新处理这些邮件。", "error")
         st.session_state.run_summary['error'] = str(e_imap)
-        save_current_run_datetime() 
         return 
     except Exception as e_main_loop:
-        append_log(f"主处理循环中发生意外错误: {e_main_loop}", "error")
+        append_log(f"主处理循环中发生意外错误: {e_main_loop}。运行记录未更新，下次将重新处理这些邮件。", "error")
         st.session_state.run_summary['error'] = str(e_main_loop)
         import traceback
-        st.session_state.processing_log.append(traceback.format_exc())
-        save_current_run_datetime()
+        append_log(traceback.format_exc(), "error")
         return
 
     st.session_state.run_summary['emails_analyzed_count'] = actual_emails_processed_count
@@ -472,7 +1395,7 @@ def run_processing(process_all_mode: bool = False):
     if actual_emails_processed_count == 0 and not st.session_state.run_summary.get('emails_found_server', 0) > 0 :
         append_log("\n本次运行未在服务器上发现需要处理的邮件。", "info")
         st.session_state.run_summary['nav_rows_extracted'] = 0
-        save_current_run_datetime() 
+        save_current_run_state() 
         return
     elif actual_emails_processed_count == 0 and st.session_state.run_summary.get('emails_found_server', 0) > 0 :
         if not process_all_mode: 
@@ -480,46 +1403,47 @@ def run_processing(process_all_mode: bool = False):
         else: 
              append_log("\n服务器上找到邮件，但筛选后无待处理邮件。", "info")
         st.session_state.run_summary['nav_rows_extracted'] = 0
-        save_current_run_datetime()
+        save_current_run_state()
         return
 
     if not rows:
         append_log("\n已处理邮件，但未捕获到基金净值数据。", "info")
         st.session_state.run_summary['nav_rows_extracted'] = 0
-        save_current_run_datetime() 
+        save_current_run_state() 
         return
 
-    df = pd.DataFrame(rows, columns=COLS)
-    df.drop_duplicates(inplace=True) 
+    # Transpose once into per-column sequences: pandas then infers each column's dtype
+    # directly instead of going through a row-major object array
+    df = pd.DataFrame(dict(zip(COLS, zip(*rows.values()))), columns=COLS)
+    coerced_df = coerce_nav_columns(df)
+    if len(coerced_df) < len(df):
+        append_log(f"    已跳过 {len(df) - len(coerced_df)} 行数据(净值无法转换为浮点数)", "warning")
+    df = coerced_df
     st.session_state.run_summary['nav_rows_extracted'] = len(df)
 
     if df.empty:
         append_log("\n处理并移除重复项后，未捕获到唯一的基金净值数据。", "info")
-        save_current_run_datetime() 
+        save_current_run_state() 
         return
     
     st.session_state.processed_df = df
 
     try:
-        file_exists = pathlib.Path(XLSX).exists()
-        if file_exists:
-            with pd.ExcelWriter(XLSX, engine="openpyxl", mode="a", if_sheet_exists="replace") as writer:
-                df.to_excel(writer, index=False, sheet_name=SHEET, header=True)
-        else:
-            with pd.ExcelWriter(XLSX, engine="openpyxl", mode="w") as writer:
-                df.to_excel(writer, index=False, sheet_name=SHEET, header=True)
-        append_log(f"\n{len(df)} 行唯一数据已写入/更新至 {XLSX} (工作表: {SHEET})", "info")
+        snapshot_df = update_nav_store(df)
+        write_xlsx(snapshot_df, XLSX)
+        append_log(f"\n{len(df)} 行唯一数据已并入当日存档，{XLSX} (工作表: {SHEET}) 现共 {len(snapshot_df)} 行", "info")
     except Exception as e:
         append_log(f"    写入本地Excel文件 '{XLSX}' 失败: {e}。", "error")
         timestamp_fallback = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         fallback_xlsx = f"{pathlib.Path(XLSX).stem}_fallback_{timestamp_fallback}{pathlib.Path(XLSX).suffix}"
         try:
-            df.to_excel(fallback_xlsx, index=False, sheet_name=SHEET)
+            write_xlsx(df, fallback_xlsx)
             append_log(f"\n数据已保存至备用文件: {fallback_xlsx}", "warning")
         except Exception as fe:
-            append_log(f"    写入备用Excel文件 '{fallback_xlsx}' 失败: {fe}。", "error")
+            append_log(f"    写入备用Excel文件 '{fallback_xlsx}' 失败: {fe}。运行记录未更新，下次将重新处理这些邮件。", "error")
+            return # Rows not on disk: keep the previous UID so they are fetched again
 
-    save_current_run_datetime() 
+    save_current_run_state() 
     append_log("\n脚本执行周期结束。", "info")
 
 # ─── Streamlit UI Configuration ───────────────────────────────────────
@@ -533,14 +1457,13 @@ st.sidebar.text_input("邮箱用户", value=EMAIL_USER, disabled=True)
 st.header("运行控制与信息")
 
 last_run_ts_display = "尚未运行或未找到日志文件。"
-if LAST_RUN_FILE.exists():
-    try:
-        content = LAST_RUN_FILE.read_text().strip()
-        if content:
-            datetime.datetime.strptime(content, DATETIME_FORMAT) 
-            last_run_ts_display = f"{content} UTC"
-    except Exception:
-        last_run_ts_display = "读取上次运行时间戳错误或格式无效。"
+try:
+    last_run_record = read_last_run_record()
+    if last_run_record:
+        last_run_ts_display = (f"{last_run_record.get('saved_at') or '时间未知'} UTC "
+                               f"(UID {int(last_run_record['uid'])})")
+except Exception:
+    last_run_ts_display = "读取上次运行记录错误或格式无效。"
 st.info(f"上次成功处理记录于: **{last_run_ts_display}**")
 
 # --- Buttons for processing ---
@@ -555,6 +1478,9 @@ with col2:
         with st.spinner("正在处理收件箱中的所有邮件... 请稍候。"):
             run_processing(process_all_mode=True)
 
+st.checkbox("持续监听新邮件 (IMAP IDLE)", key="imap_idle_listen",
+            help="保持IMAP连接，服务器推送新邮件时自动运行“处理新邮件”。取消勾选或点击右上角 Stop 停止监听。")
+
 if hasattr(st.session_state, 'current_run_timestamp_display') and st.session_state.current_run_timestamp_display:
     st.success(f"当前处理周期完成于: **{st.session_state.current_run_timestamp_display}**")
 
@@ -574,10 +1500,11 @@ st.subheader("提取数据")
 if st.session_state.processed_df is not None and not st.session_state.processed_df.empty:
     st.dataframe(st.session_state.processed_df)
     
-    output_excel = io.BytesIO()
-    with pd.ExcelWriter(output_excel, engine='openpyxl') as writer:
-        st.session_state.processed_df.to_excel(writer, index=False, sheet_name=SHEET)
-    excel_bytes = output_excel.getvalue()
+    if st.session_state.processed_xlsx is None:
+        output_excel = io.BytesIO()
+        write_xlsx(st.session_state.processed_df, output_excel)
+        st.session_state.processed_xlsx = output_excel.getvalue()
+    excel_bytes = st.session_state.processed_xlsx
 
     st.download_button(
         label="下载 Excel 文件",
@@ -593,14 +1520,34 @@ else:
 st.subheader("处理日志")
 with st.expander("显示/隐藏详细日志", expanded=False):
     if st.session_state.processing_log:
-        for log_entry in reversed(st.session_state.processing_log):
-            if "GLM从" in log_entry and "未能从" not in log_entry :
-                 st.success(log_entry) 
-            elif "警告" in log_entry or "失败" in log_entry or "错误" in log_entry or "Error" in log_entry.title():
-                 st.warning(log_entry) 
-            else:
-                 st.text(log_entry)
+        # One virtualized table instead of one widget per line: cost no longer grows with log length
+        log_df = pd.DataFrame([(LOG_LEVEL_ICONS[level], entry)
+                               for level, entry in reversed(st.session_state.processing_log)],
+                              columns=["级别", "日志"])
+        st.dataframe(log_df, height=400, hide_index=True)
     else:
         st.caption("日志为空。")
 
+# --- IMAP IDLE listener: last on the page, so the results above are rendered before it blocks ---
+if st.session_state.get("imap_idle_listen"):
+    idle_status = st.empty()
+    reconnect_delay = 1
+    while True:
+        idle_status.info("正在监听新邮件 (IMAP IDLE)...")
+        try:
+            # Redrawing the status each second is the st call through which Stop/reruns get in
+            has_new_mail = wait_for_new_mail(on_poll=lambda: idle_status.info("正在监听新邮件 (IMAP IDLE)..."))
+            reconnect_delay = 1
+        except (IMAP_ERROR, OSError) as e: # BYE, dropped connection...
+            st.session_state.imap_client = None
+            for wait_left in range(reconnect_delay, 0, -IDLE_POLL_SECONDS): # Sliced like the IDLE wait itself
+                idle_status.warning(f"IMAP监听连接中断: {e}，{wait_left} 秒后重新连接。")
+                time.sleep(min(IDLE_POLL_SECONDS, wait_left))
+            reconnect_delay = min(reconnect_delay * 2, IDLE_TIMEOUT)
+            continue
+        if has_new_mail:
+            with st.spinner("收到新邮件，正在处理..."):
+                run_processing(process_all_mode=False)
+            st.rerun() # Redraw summary/data/log with this run's results, then listen again
+
 # To run: streamlit run your_script_name.py